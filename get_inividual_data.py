@@ -6,7 +6,16 @@ import csv
 from bs4 import BeautifulSoup
 from selenium import webdriver
 import re
+from bisect import bisect_right
+from datetime import datetime
 from dateutil.parser import parse
+
+# Party recorded for an MP who is missing from a later TheyWorkForYou CSV.
+NOT_SITTING = 'Not sitting'
+# Pickled party names that are spelled differently in the TheyWorkForYou CSVs.
+PARTY_NAMES = {'Liberal Democrats': 'Liberal Democrat',
+               'Democratic Unionist Party': 'DUP'}
+
 ### CLASSES ###
 
 class MP:
@@ -15,12 +24,40 @@ class MP:
     donations attributes. Provide methods to add a donation and calculate
     total donations received.
     """
-    def __init__(self, name, constituency = 'Unknown', party = 'Unknown', url = ''):
+    def __init__(self, name, constituency = 'Unknown', party = 'Unknown', url = '', person_id = ''):
         self.name = name
         self.constituency = constituency
         self.party = party
         self.url = url
+        self.person_id = person_id
         self.donations = []
+        # (effective date, party, constituency), oldest first, with the
+        #   dates kept in a parallel list for bisecting.
+        self.memberships = []
+        self.membership_dates = []
+
+    def add_membership(self, effective_date, party, constituency):
+        # Only record a new entry when the party or seat actually changes.
+        if self.memberships and self.memberships[-1][1:] == (party, constituency):
+            return
+        self.memberships.append((effective_date, party, constituency))
+        self.membership_dates.append(effective_date)
+        self.party = party
+        self.constituency = constituency
+
+    def membership_on(self, date):
+        """
+        Return the (party, constituency) the MP held on the given date, or
+        'Unknown' for both when the date is before the first known membership.
+        """
+        # MPs unpickled from before memberships existed have no history.
+        memberships = getattr(self, 'memberships', [])
+        if not memberships:
+            return (self.party, self.constituency)
+        index = bisect_right(self.membership_dates, date) - 1
+        if index < 0:
+            return ('Unknown', 'Unknown')
+        return memberships[index][1:]
 
     def add_donation(self, amount, interest_type, date, hours, text_):
         self.donations.append({"amount": amount,
@@ -314,28 +351,127 @@ def textscrape_freebies(name):
     # https://publications.parliament.uk/pa/cm201719/cmcode/1882/188204.htm
     return donations
 
-def mp_generator(theyworkforyou_csv):
-    # Load CSV and get party and constituency data
-    unmatched_mps = []
+def stream_theyworkforyou_csv(theyworkforyou_csv):
+    # Yield one row at a time rather than loading the whole file into memory.
+    with open(theyworkforyou_csv, 'r', encoding = 'utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            yield row
+
+def join_theyworkforyou_csvs(theyworkforyou_csvs):
+    """
+    Hash-join every TheyWorkForYou CSV vintage on 'Person ID' in one pass,
+    building effective-dated party and constituency memberships for each MP.
+    MPs missing from a later vintage are given a NOT_SITTING membership.
+    :param theyworkforyou_csvs: list of (csv file name, effective date) pairs
+    :return: dictionary of MP objects keyed by Person ID, including former MPs
+    """
     mps = {}
+    vintages = sorted(((parse(date), csv_file)
+                       for csv_file, date in theyworkforyou_csvs))
+    for effective_date, csv_file in vintages:
+        sitting = set()
+        for row in stream_theyworkforyou_csv(csv_file):
+            person_id = row['Person ID']
+            sitting.add(person_id)
+            mp_full_name = (row['First name'], row['Last name'])
+            mp = mps.get(person_id)
+            if mp is None:
+                mp = MP(name=mp_full_name, person_id=person_id)
+                mps[person_id] = mp
+            # Later vintages take precedence for the MP's current name.
+            mp.name = mp_full_name
+            mp.add_membership(effective_date, row['Party'], row['Constituency'])
+        for person_id, mp in mps.items():
+            if person_id not in sitting:
+                mp.add_membership(effective_date, NOT_SITTING, None)
+    return mps
 
-    with open(theyworkforyou_csv, 'r', encoding = 'utf-8') as csvfile:
-        csv_reader = csv.reader(csvfile)
-        next(csv_reader)
-        rows = list(csv_reader)
+def migrate_pickled_mps(mps, joined_mps):
+    """
+    Copy Person IDs and membership history onto MP objects pickled before
+    they existed. Pickled MPs are keyed by their register name
+    ('Last, Title First '), so they are matched on last name plus either the
+    first name or any constituency held. Failing that, they are matched on
+    first name and the constituency held in the earliest CSV vintage, which
+    catches MPs whose surname changed or is spelled differently.
+    The CSVs start after the register period, so the pickled party and
+    constituency are kept as the earliest membership and cover every
+    donation dated before the first vintage. MPs without exactly one match
+    keep only their pickled party.
+    :param mps: dictionary of pickled MP objects
+    :param joined_mps: output of join_theyworkforyou_csvs
+    """
+    first_vintage = min(joined_mp.membership_dates[0]
+                        for joined_mp in joined_mps.values())
+    by_last_name = {}
+    by_first_constituency = {}
+    for joined_mp in joined_mps.values():
+        last_name = joined_mp.name[1].lower().replace('-', ' ')
+        by_last_name.setdefault(last_name, []).append(joined_mp)
+        if joined_mp.membership_dates[0] == first_vintage:
+            constituency = joined_mp.memberships[0][2]
+            by_first_constituency.setdefault(constituency, []).append(joined_mp)
+
+    for mp in mps.values():
+        mp.party = PARTY_NAMES.get(mp.party, mp.party)
+        last_name, _, first_names = mp.name.partition(',')
+        last_name = last_name.strip().lower().replace('-', ' ')
+        first_name = first_names.split()[-1].lower() if first_names.split() else ''
+        matches = [joined_mp for joined_mp in by_last_name.get(last_name, [])
+                   if joined_mp.name[0].lower() == first_name
+                   or any(membership[2] == mp.constituency
+                          for membership in joined_mp.memberships)]
+        if len(matches) != 1:
+            matches = [joined_mp
+                       for joined_mp in by_first_constituency.get(mp.constituency, [])
+                       if joined_mp.name[0].lower() == first_name]
+        if len(matches) == 1:
+            register_party, register_constituency = mp.party, mp.constituency
+            mp.person_id = matches[0].person_id
+            mp.memberships = []
+            mp.membership_dates = []
+            mp.add_membership(datetime.min, register_party, register_constituency)
+            for membership in matches[0].memberships:
+                mp.add_membership(*membership)
+
+def attach_donation_memberships(mps):
+    """
+    Add the party and constituency each MP held on the date of every donation.
+    Donations without a parseable date come from the register, so they get
+    the MP's earliest membership.
+    """
+    for mp in mps.values():
+        for donation in mp.donations:
+            try:
+                donation_date = parse(donation['date'])
+            except (TypeError, ValueError, OverflowError):
+                donation_date = datetime.min
+            party, constituency = mp.membership_on(donation_date)
+            donation['party'] = party
+            donation['constituency'] = constituency
+
+def donation_parties(mp):
+    """
+    Return the parties stamped on an MP's donations, or the party held in the
+    register period (their earliest membership) when they have no donations.
+    """
+    parties = {donation['party'] for donation in mp.donations}
+    return parties if parties else {mp.membership_on(datetime.min)[0]}
 
-    for row in rows:
-        mp_full_name = (row[1], row[2])
-        mp_party = row[3]
-        mp_constituency = row[4]
-        mps[mp_full_name] = MP(name=mp_full_name, party=mp_party, constituency=mp_constituency)
+def mp_generator(theyworkforyou_csvs):
+    # Join every CSV vintage to get party and constituency data, keeping only
+    #   MPs sitting in the latest vintage. Older vintages supply history.
+    unmatched_mps = []
+    mps = {person_id: mp
+           for person_id, mp in join_theyworkforyou_csvs(theyworkforyou_csvs).items()
+           if mp.party != NOT_SITTING}
 
     matched_mp_files = []  # Separate list to store matched file names
 
     for file_name in os.listdir('HTML_Files'):
         matched = False  # Flag to track whether the current file is matched
-        for mp_full_name, mp in mps.items():
-            if all(x in file_name for x in mp_full_name) and file_name not in matched_mp_files:
+        for mp in mps.values():
+            if all(x in file_name for x in mp.name) and file_name not in matched_mp_files:
                 mp_url = os.path.join('HTML_Files', file_name)
                 mp.url = mp_url
                 matched = True
@@ -352,14 +488,26 @@ def mp_generator(theyworkforyou_csv):
 
 
 ### MAIN CODE ###
-mps = mp_generator('mps_2024.csv')
+# Placeholder effective dates: the download dates of these files were not
+#   recorded, so each is the earliest date consistent with its contents.
+#   mps_2023.csv has the Dec 2022 by-election winners but not Feb 2023's, and
+#   mps_2024.csv has the 19 Oct 2023 winners and Peter Bone (recalled 19 Dec
+#   2023). Changes between files are only known to fall in that gap; replace
+#   these with the real snapshot dates when downloading new CSVs. Both files
+#   postdate the register period, so they give no history for it.
+theyworkforyou_csvs = [('mps_2023.csv', '16 December 2022'),
+                       ('mps_2024.csv', '20 October 2023')]
+mps = mp_generator(theyworkforyou_csvs)
 # for mp in mps.values():
 #     print(mp.name)
 quit()
 
 
-# Load MP Object dictionary from file
+# Load MP Object dictionary from file and stamp each donation with the
+#   party and constituency held on its date.
 mps = pickle_io('New_MP_Object_Dict', load = True)
+migrate_pickled_mps(mps, join_theyworkforyou_csvs(theyworkforyou_csvs))
+attach_donation_memberships(mps)
 
 
 ## Find and print average MP interest amount.
@@ -368,18 +516,26 @@ for mp in mps.values():
     donations.append(mp.total_donations())
 print(f"MP Average: {sum(donations)/len(donations)}")
 print(f"MP Total: {sum(donations)}\n")
-# Set up a list of parties
+# Set up a list of parties from the party held on each donation's date
 for mp in mps.values():
     if mp.party == 'Labour/Co-operative':
         mp.party = 'Labour'
-parties = list({mps[mp].party for mp in mps})
+    for donation in mp.donations:
+        if donation['party'] == 'Labour/Co-operative':
+            donation['party'] = 'Labour'
+mp_parties = {name: {'Labour' if party == 'Labour/Co-operative' else party
+                     for party in donation_parties(mp)}
+              for name, mp in mps.items()}
+parties = list(set().union(*mp_parties.values()) - {NOT_SITTING})
 # Find average Party MP interest amount.
 party_averages = {}
 for party in parties:
     donations = []
-    for mp in mps.values():
-        if mp.party == party:
-            donations.append(mp.total_donations())
+    for name, mp in mps.items():
+        if party in mp_parties[name]:
+            donations.append(sum(float(donation['amount'])
+                                 for donation in mp.donations
+                                 if donation['party'] == party))
     party_averages[party] = [round(sum(donations)/len(donations)), round(sum(donations))]
 # Print values
 for party, amount in sorted(party_averages.items(), key=lambda item: item[1]):
@@ -387,8 +543,8 @@ for party, amount in sorted(party_averages.items(), key=lambda item: item[1]):
 
 ## Display donation totals for each MP
 mp_totals = {}
-for mp in mps.values():
-    mp_totals[mp.name] = (mp.total_donations(), mp.party)
+for name, mp in mps.items():
+    mp_totals[mp.name] = (mp.total_donations(), '/'.join(sorted(mp_parties[name])))
 for mp, amount in sorted(mp_totals.items(), key=lambda item: item[1]):
     print(f"{mp}, {amount[1]}: {amount[0]}")
         
@@ -404,4 +560,5 @@ for mp, amount in sorted(mp_totals.items(), key=lambda item: item[1]):
                                # ~ donation['hours'],
                                # ~ donation['text'])
     # ~ print(f"Saving new donation data for {name}...")
+    # ~ attach_donation_memberships(mps)
     # ~ pickle_io('New_MP_Object_Dict', data = mps, save = True)